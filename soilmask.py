@@ -1,17 +1,22 @@
 #!/usr/bin/env python3
 """Soil masking Transformer
 """
+# pylint: disable=too-many-lines
 
 import argparse
 import logging
 import os
+from typing import Optional
 import numpy as np
 from agpypeline import entrypoint, algorithm, geoimage
 from agpypeline.environment import Environment
 from agpypeline.checkmd import CheckMD
 import cv2
 
+import osgeo
 from osgeo import gdal
+from osgeo import ogr
+from osgeo import osr
 # from PIL import Image  Used by code that's getting deprecated
 from skimage import morphology
 
@@ -21,10 +26,31 @@ SATURATE_THRESHOLD = 245
 MAX_PIXEL_VAL = 255
 SMALL_AREA_THRESHOLD = 200
 
+# Coarse-to-fine masking: uncertain areas are found in tiles of this size, and each group of neighboring
+# tiles is masked at full resolution with this many pixels of padding for context
+COARSE_TILE_SIZE = 64
+COARSE_TILE_PADDING = 32
+# The whole image is masked at full resolution when the padded groups cover more than this part of it
+COARSE_MAX_REFINE_RATIO = 0.5
+# Coarse pixels around uncertain regions that are refined at full resolution
+COARSE_BAND_SIZE = 2
+
+# Vector output: the mask is polygonized in tiles of this size
+VECTOR_TILE_SIZE = 4096
+# Supported vector file extensions and their OGR drivers
+VECTOR_DRIVERS = {'.geojson': 'GeoJSON', '.gpkg': 'GPKG'}
+
+# Image file types that are decoded with OpenCV instead of GDAL
+OPENCV_FILE_EXT = ('.jpg', '.jpeg', '.png')
+# Image file types that support a fast reduced size decode for the quality check
+REDUCED_DECODE_FILE_EXT = ('.jpg', '.jpeg')
+TIFF_FILE_EXT = ('.tiff', '.tif')
+
 
 class __internal__:
     """Class for functions intended for internal use only for this file
     """
+    # pylint: disable=too-many-public-methods
     def __init__(self):
         """Performs initialization of class instance
         """
@@ -196,21 +222,219 @@ class __internal__:
         return bin_mask
 
     @staticmethod
-    def gen_mask(img: np.ndarray, kernel_size: int) -> np.ndarray:
+    def restore_clipped_changes(before_mask: np.ndarray, after_mask: np.ndarray, clipped_edges: tuple) -> np.ndarray:
+        """Undoes the area and hole removal changes that touch the clipped edges of an image window
+        Arguments:
+            before_mask: the mask before the areas or holes were removed
+            after_mask: the mask after the areas or holes were removed
+            clipped_edges: tuple of (top, bottom, left, right) flags that are True when that edge of the window
+                           cuts through the image
+        Return:
+            A new mask with the changes touching the clipped edges undone
+        Notes:
+            Areas and holes cut by a clipped edge can look smaller than they really are
+        """
+        labels = morphology.label(before_mask != after_mask, connectivity=1)
+
+        top, bottom, left, right = clipped_edges
+        edge_labels = [edge for edge, clipped in [(labels[0, :], top), (labels[-1, :], bottom),
+                                                  (labels[:, 0], left), (labels[:, -1], right)] if clipped]
+        if not edge_labels:
+            return after_mask
+        edge_labels = np.unique(np.concatenate(edge_labels))
+        edge_labels = edge_labels[edge_labels > 0]
+        if edge_labels.size == 0:
+            return after_mask
+
+        clipped_areas = np.isin(labels, edge_labels)
+        rel_img = after_mask.copy()
+        rel_img[clipped_areas] = before_mask[clipped_areas]
+
+        return rel_img
+
+    @staticmethod
+    def gen_mask(img: np.ndarray, kernel_size: int, clipped_edges: tuple = None) -> np.ndarray:
         """Generated the mask for plants
         Arguments:
             img: the image used to mask in plants
             kernel_size: the size of the image processing kernel
+            clipped_edges: optional tuple of (top, bottom, left, right) flags that are True when that edge of
+                           the image is a window edge inside a larger image (see restore_clipped_changes())
         Return:
             A new image mask
         """
-        bin_mask = __internal__.gen_plant_mask(img, kernel_size)
-        bin_mask = __internal__.remove_small_area_mask(bin_mask, SMALL_AREA_THRESHOLD)
+        plant_mask = __internal__.gen_plant_mask(img, kernel_size)
+        bin_mask = __internal__.remove_small_area_mask(plant_mask, SMALL_AREA_THRESHOLD)
+        if clipped_edges:
+            bin_mask = __internal__.restore_clipped_changes(plant_mask, bin_mask, clipped_edges)
+
+        area_mask = bin_mask
         bin_mask = __internal__.remove_small_holes_mask(bin_mask,
                                                         3000)  # 3000 is a parameter for number of pixels to be filled as small holes
+        if clipped_edges:
+            bin_mask = __internal__.restore_clipped_changes(area_mask, bin_mask, clipped_edges)
 
         return bin_mask
 
+    @staticmethod
+    def gen_bin_mask(img: np.ndarray, kernel_size: int, saturated: bool) -> np.ndarray:
+        """Generates the plant mask for an image at full resolution
+        Arguments:
+            img: the image used to mask in plants
+            kernel_size: the size of the image processing kernel
+            saturated: set to True if the image is over saturated
+        Return:
+            A new image mask
+        """
+        if saturated:
+            return __internal__.gen_saturated_mask(img, kernel_size)
+        return __internal__.gen_mask(img, kernel_size)
+
+    @staticmethod
+    def gen_uncertain_mask(coarse_plants: np.ndarray, coarse_mask: np.ndarray = None,
+                           band_size: int = COARSE_BAND_SIZE) -> np.ndarray:
+        """Finds the areas of a coarse mask that need to be generated at full resolution
+        Arguments:
+            coarse_plants: the plant mask of the decimated image before the area and hole removal
+            coarse_mask: the mask generated from the decimated image; if None, only the boundaries of
+                         coarse_plants are used as a quick estimate
+            band_size: the number of coarse pixels to grow the uncertain areas by
+        Return:
+            A boolean array, the same size as the coarse mask, with uncertain pixels set to True
+        Notes:
+            Uncertain pixels are the plant/soil boundaries and the pixels changed by the area and hole removal
+        """
+        kernel = np.ones((3, 3), np.uint8)
+        if coarse_mask is None:
+            uncertain_pixels = cv2.dilate(coarse_plants, kernel) != cv2.erode(coarse_plants, kernel)
+        else:
+            uncertain_pixels = (cv2.dilate(coarse_mask, kernel) != cv2.erode(coarse_mask, kernel)) | \
+                               (coarse_plants != coarse_mask)
+
+        uncertain = np.zeros_like(coarse_plants)
+        uncertain[uncertain_pixels] = MAX_PIXEL_VAL
+        if band_size > 0:
+            uncertain = cv2.dilate(uncertain, np.ones((2 * band_size + 1, 2 * band_size + 1), np.uint8))
+
+        return uncertain > 0
+
+    @staticmethod
+    def get_refine_windows(uncertain: np.ndarray, shape: tuple, tile_size: int, padding: int) -> tuple:
+        """Groups the uncertain areas into windows to generate at full resolution
+        Arguments:
+            uncertain: the uncertain areas of the coarse mask (see gen_uncertain_mask())
+            shape: the full resolution image shape
+            tile_size: the size of the tiles used to find the areas to refine
+            padding: the number of context pixels around each group of tiles
+        Return:
+            A tuple containing the full resolution pixels to refine, the list of windows as
+            ((top, bottom, left, right), (padded top, padded bottom, padded left, padded right)) tuples, and
+            the number of pixels in the padded windows
+        """
+        # pylint: disable=too-many-locals
+        height, width = shape[:2]
+        refine = cv2.resize(uncertain.astype(np.uint8), (width, height), interpolation=cv2.INTER_NEAREST) > 0
+
+        # Find the tiles to refine and group neighboring tiles so they're masked together
+        tile_rows, tile_cols = -(-height // tile_size), -(-width // tile_size)
+        tile_refine = np.zeros((tile_rows * tile_size, tile_cols * tile_size), dtype=bool)
+        tile_refine[:height, :width] = refine
+        tile_refine = np.any(tile_refine.reshape((tile_rows, tile_size, tile_cols, tile_size)), axis=(1, 3))
+        num, _, stats, _ = cv2.connectedComponentsWithStats(tile_refine.astype(np.uint8), connectivity=8)
+
+        windows = []
+        refine_area = 0
+        for idx in range(1, num):
+            left, top = stats[idx, cv2.CC_STAT_LEFT] * tile_size, stats[idx, cv2.CC_STAT_TOP] * tile_size
+            right = min(width, left + stats[idx, cv2.CC_STAT_WIDTH] * tile_size)
+            bottom = min(height, top + stats[idx, cv2.CC_STAT_HEIGHT] * tile_size)
+            pad_top, pad_left = max(0, top - padding), max(0, left - padding)
+            pad_bottom, pad_right = min(height, bottom + padding), min(width, right + padding)
+            windows.append(((top, bottom, left, right), (pad_top, pad_bottom, pad_left, pad_right)))
+            refine_area += (pad_bottom - pad_top) * (pad_right - pad_left)
+
+        return refine, windows, refine_area
+
+    @staticmethod
+    def gen_coarse_to_fine_mask(img: np.ndarray, kernel_size: int, saturated: bool, scale: int,
+                                tile_size: int = COARSE_TILE_SIZE, padding: int = COARSE_TILE_PADDING) -> np.ndarray:
+        """Generates the plant mask on a decimated image and refines the uncertain areas at full resolution
+        Arguments:
+            img: the image used to mask in plants
+            kernel_size: the size of the image processing kernel
+            saturated: set to True if the image is over saturated
+            scale: the decimation factor of the coarse image
+            tile_size: the size of the tiles used to find the areas to refine
+            padding: the number of context pixels around each group of tiles refined at full resolution
+        Return:
+            A new image mask
+        Notes:
+            The area and hole removal steps only see a window's padded neighborhood at full resolution.
+            Plant areas and holes touching a padded window edge inside the image are left unchanged since
+            they may be larger than they appear; small ones are kept instead of being removed or filled, so
+            the result can differ from the mask returned by gen_bin_mask() near those edges.
+            Over saturated images are always masked at full resolution since the saturation processing
+            depends on the size of the saturated areas in the whole image.
+            When the areas to refine cover most of the image (dense canopy), the whole image is masked at
+            full resolution since that's faster
+        """
+        # pylint: disable=too-many-arguments, too-many-locals
+        if saturated:
+            return __internal__.gen_bin_mask(img, kernel_size, saturated)
+
+        height, width = img.shape[:2]
+        max_refine_area = COARSE_MAX_REFINE_RATIO * height * width
+        coarse_size = (max(1, width // scale), max(1, height // scale))
+        coarse_img = cv2.resize(img, coarse_size, interpolation=cv2.INTER_AREA)
+        coarse_plants = __internal__.gen_plant_mask(coarse_img, kernel_size)
+
+        # Quick check using the plant boundaries to avoid generating the coarse mask when it won't be used
+        _, _, refine_area = __internal__.get_refine_windows(__internal__.gen_uncertain_mask(coarse_plants),
+                                                            img.shape, tile_size, padding)
+        if refine_area > max_refine_area:
+            return __internal__.gen_bin_mask(img, kernel_size, saturated)
+
+        coarse_mask = __internal__.gen_bin_mask(coarse_img, kernel_size, saturated)
+        refine, windows, refine_area = __internal__.get_refine_windows(
+            __internal__.gen_uncertain_mask(coarse_plants, coarse_mask), img.shape, tile_size, padding)
+        if refine_area > max_refine_area:
+            return __internal__.gen_bin_mask(img, kernel_size, saturated)
+
+        bin_mask = cv2.resize(coarse_mask, (width, height), interpolation=cv2.INTER_NEAREST)
+        for (top, bottom, left, right), (pad_top, pad_bottom, pad_left, pad_right) in windows:
+            fine_mask = __internal__.gen_mask(img[pad_top:pad_bottom, pad_left:pad_right], kernel_size,
+                                              (pad_top > 0, pad_bottom < height, pad_left > 0, pad_right < width))
+            fine_mask = fine_mask[top - pad_top:bottom - pad_top, left - pad_left:right - pad_left]
+
+            window_refine = refine[top:bottom, left:right]
+            window_mask = bin_mask[top:bottom, left:right]
+            window_mask[window_refine] = fine_mask[window_refine]
+
+        return bin_mask
+
+    @staticmethod
+    def compare_masks(reference: np.ndarray, candidate: np.ndarray) -> dict:
+        """Compares a mask against a reference mask
+        Arguments:
+            reference: the reference mask, usually generated at full resolution
+            candidate: the mask to compare
+        Return:
+            A dict containing the intersection over union of the plant pixels ('iou'), the number of
+            pixels that are different ('differing_pixels'), and the ratio of different pixels ('differing_ratio')
+        """
+        reference_plants = reference > 0
+        candidate_plants = candidate > 0
+
+        union = np.count_nonzero(reference_plants | candidate_plants)
+        intersection = np.count_nonzero(reference_plants & candidate_plants)
+        differing = np.count_nonzero(reference_plants != candidate_plants)
+
+        return {
+            'iou': float(intersection) / float(union) if union else 1.0,
+            'differing_pixels': int(differing),
+            'differing_ratio': float(differing) / float(reference.size)
+        }
+
     @staticmethod
     def gen_rgb_mask(img: np.ndarray, bin_mask: np.ndarray) -> np.ndarray:
         """Applies the mask to the image
@@ -227,6 +451,259 @@ class __internal__:
 
         return rgb_mask
 
+    @staticmethod
+    def get_geotransform(bounds: tuple, width: int, height: int) -> tuple:
+        """Returns the geotransform of an image
+        Arguments:
+            bounds: the geographic bounds of the image as (min_y, max_y, min_x, max_x); if None the
+                    returned geotransform is in pixel coordinates
+            width: the width of the image in pixels
+            height: the height of the image in pixels
+        Return:
+            A tuple containing the GDAL geotransform
+        """
+        if bounds is None:
+            return 0.0, 1.0, 0.0, 0.0, 0.0, 1.0
+
+        return (
+            bounds[2],  # upper-left x
+            (bounds[3] - bounds[2]) / float(width),  # W-E pixel resolution
+            0.0,  # rotation (0 = North is up)
+            bounds[1],  # upper-left y
+            0.0,  # rotation (0 = North is up)
+            -((bounds[1] - bounds[0]) / float(height))  # N-S pixel resolution
+        )
+
+    @staticmethod
+    def get_spatial_reference(epsg: int) -> Optional[osr.SpatialReference]:
+        """Returns the spatial reference for an EPSG code
+        Arguments:
+            epsg: the EPSG code
+        Return:
+            The spatial reference using the traditional GIS axis order (x, y), or None if the EPSG code is not specified
+        """
+        if not epsg:
+            return None
+
+        srs = osr.SpatialReference()
+        if int(osgeo.__version__[0]) >= 3:
+            # GDAL 3 changes axis order: https://github.com/OSGeo/gdal/issues/1546
+            # pylint: disable=no-member
+            srs.SetAxisMappingStrategy(osgeo.osr.OAMS_TRADITIONAL_GIS_ORDER)
+        srs.ImportFromEPSG(int(epsg))
+
+        return srs
+
+    @staticmethod
+    def create_raw_image(out_path: str, shape: tuple, bounds: tuple = None, epsg: int = None,
+                         image_md: dict = None) -> np.memmap:
+        """Creates an uncompressed ENVI image and returns its memory mapped pixels for filling
+        Arguments:
+            out_path: the path of the image file to create; the ENVI header is saved next to it with the
+                      '.hdr' extension
+            shape: the shape of the image as (rows, columns) or (rows, columns, bands)
+            bounds: the geographic bounds of the image as (min_y, max_y, min_x, max_x); if None the image isn't
+                    georeferenced
+            epsg: the EPSG code of the bounds
+            image_md: metadata to save with the image
+        Return:
+            The writable memory mapped pixels of the image. The pixels are saved when the returned
+            array is flushed or deleted
+        Exceptions:
+            RuntimeError is raised if the image can't be created
+        Notes:
+            The bands are pixel interleaved (BIP) so the file contents have the same layout as a
+            row-major numpy array of the specified shape
+        """
+        height, width = shape[:2]
+        bands = shape[2] if len(shape) > 2 else 1
+
+        raster = gdal.GetDriverByName('ENVI').Create(out_path, width, height, bands, gdal.GDT_Byte,
+                                                     ['INTERLEAVE=BIP'])
+        if raster is None:
+            raise RuntimeError("Unable to create raw image file '%s'" % out_path)
+        if bounds is not None:
+            raster.SetGeoTransform(__internal__.get_geotransform(bounds, width, height))
+            srs = __internal__.get_spatial_reference(epsg)
+            if srs is not None:
+                raster.SetProjection(srs.ExportToWkt())
+        if image_md:
+            raster.SetMetadata(image_md)
+        # Close the image to write the header before mapping the pixels
+        raster = None
+
+        # Make sure the file is large enough to map all the pixels
+        if os.path.getsize(out_path) < height * width * bands:
+            os.truncate(out_path, height * width * bands)
+
+        return np.memmap(out_path, dtype=np.uint8, mode='r+', shape=tuple(shape))
+
+    @staticmethod
+    def open_raw_image(file_path: str, writable: bool = False) -> np.memmap:
+        """Maps the pixels of an image created by create_raw_image() without decoding them
+        Arguments:
+            file_path: the path of the image file
+            writable: set to True to be able to change the pixels
+        Return:
+            The memory mapped pixels of the image as (rows, columns) or (rows, columns, bands)
+        """
+        raster = gdal.Open(file_path)
+        shape = (raster.RasterYSize, raster.RasterXSize)
+        if raster.RasterCount > 1:
+            shape = shape + (raster.RasterCount,)
+        raster = None
+
+        return np.memmap(file_path, dtype=np.uint8, mode='r+' if writable else 'r', shape=shape)
+
+    @staticmethod
+    def polygonize_mask(bin_mask: np.ndarray, out_path: str, bounds: tuple = None, epsg: int = None,
+                        min_area: int = SMALL_AREA_THRESHOLD, simplify: float = 1.0,
+                        tile_size: int = VECTOR_TILE_SIZE) -> int:
+        """Saves the plant areas of a mask as polygons
+        Arguments:
+            bin_mask: the mask to polygonize
+            out_path: the path of the GeoJSON (.geojson) or GeoPackage (.gpkg) file to write
+            bounds: the geographic bounds of the mask as (min_y, max_y, min_x, max_x); if None the polygons
+                    are saved in pixel coordinates
+            epsg: the EPSG code of the bounds
+            min_area: plant areas smaller than this number of pixels are not saved
+            simplify: the topology preserving simplification tolerance in pixels; 0 disables simplification
+            tile_size: the size of the tiles the mask is polygonized in
+        Return:
+            The number of polygons saved
+        Exceptions:
+            RuntimeError is raised if the output file type isn't supported or can't be created
+        Notes:
+            Each tile is polygonized separately to limit memory use; plant areas crossing tile edges are
+            split into several polygons. Small plant areas are removed from the whole mask before it's
+            tiled so the pieces of large plant areas are kept. Each polygon is simplified separately, so
+            the pieces of a plant area on either side of a tile edge may no longer share exactly the same edge.
+            Each polygon's 'area' field is its area in pixels after simplification, the same unit as min_area
+        """
+        # pylint: disable=too-many-arguments, too-many-locals, too-many-branches, too-many-statements
+        ext = os.path.splitext(out_path)[1].lower()
+        if ext not in VECTOR_DRIVERS:
+            raise RuntimeError("Unsupported vector file type '%s', expected one of %s" %
+                               (ext, ', '.join(VECTOR_DRIVERS.keys())))
+        driver = ogr.GetDriverByName(VECTOR_DRIVERS[ext])
+        if os.path.exists(out_path):
+            driver.DeleteDataSource(out_path)
+
+        srs = __internal__.get_spatial_reference(epsg)
+
+        height, width = bin_mask.shape[:2]
+        geotransform = __internal__.get_geotransform(bounds, width, height)
+        pixel_area = abs(geotransform[1] * geotransform[5])
+        geo_tolerance = simplify * np.sqrt(pixel_area)
+
+        out_ds = driver.CreateDataSource(out_path)
+        if out_ds is None:
+            raise RuntimeError("Unable to create vector file '%s'" % out_path)
+        out_layer = out_ds.CreateLayer('canopy', srs, ogr.wkbPolygon)
+        out_layer.CreateField(ogr.FieldDefn('area', ogr.OFTReal))
+        use_transactions = out_layer.TestCapability(ogr.OLCTransactions)
+
+        # Remove small plant areas before tiling so the pieces of large areas crossing tile edges are kept
+        plant_mask = bin_mask > 0
+        if min_area > 0:
+            plant_mask = morphology.remove_small_objects(plant_mask, min_area, connectivity=2)
+
+        raster_driver = gdal.GetDriverByName('MEM')
+        vector_driver = ogr.GetDriverByName('Memory')
+        poly_count = 0
+        for top in range(0, height, tile_size):
+            bottom = min(top + tile_size, height)
+            for left in range(0, width, tile_size):
+                right = min(left + tile_size, width)
+                tile = plant_mask[top:bottom, left:right].astype(np.uint8)
+                if not tile.any():
+                    continue
+
+                tile_ds = raster_driver.Create('', right - left, bottom - top, 1, gdal.GDT_Byte)
+                tile_ds.SetGeoTransform((geotransform[0] + left * geotransform[1], geotransform[1], 0.0,
+                                         geotransform[3] + top * geotransform[5], 0.0, geotransform[5]))
+                tile_band = tile_ds.GetRasterBand(1)
+                tile_band.WriteArray(tile)
+
+                poly_ds = vector_driver.CreateDataSource('')
+                poly_layer = poly_ds.CreateLayer('tile', srs, ogr.wkbPolygon)
+                poly_layer.CreateField(ogr.FieldDefn('value', ogr.OFTInteger))
+                # Using the tile as its own mask only returns the plant areas
+                gdal.Polygonize(tile_band, tile_band, poly_layer, 0, ['8CONNECTED=8'], callback=None)
+
+                if use_transactions:
+                    out_layer.StartTransaction()
+                for feature in poly_layer:
+                    geometry = feature.GetGeometryRef()
+                    if geo_tolerance > 0:
+                        geometry = geometry.SimplifyPreserveTopology(geo_tolerance)
+                        if geometry is None or geometry.IsEmpty():
+                            continue
+
+                    out_feature = ogr.Feature(out_layer.GetLayerDefn())
+                    out_feature.SetGeometry(geometry)
+                    out_feature.SetField('area', geometry.GetArea() / pixel_area)
+                    out_layer.CreateFeature(out_feature)
+                    poly_count += 1
+                if use_transactions:
+                    out_layer.CommitTransaction()
+
+                poly_ds = None
+                tile_ds = None
+
+        # Close the file to make sure everything is written
+        out_ds = None
+
+        return poly_count
+
+    @staticmethod
+    def load_image(input_path: str, plain_image: bool = False) -> np.ndarray:
+        """Loads an image as BGR (or BGRA) pixels
+        Arguments:
+            input_path: the path to the image
+            plain_image: set to True if the image isn't georeferenced so it's decoded with OpenCV instead of GDAL
+        Return:
+            The image pixels
+        Notes:
+            JPEG and PNG images are always decoded with OpenCV. GDAL is used if OpenCV can't decode the image.
+            The pixels are the same as GDAL returns, except that JPEG pixels may differ by one when OpenCV and
+            GDAL use libjpeg builds that round differently
+        """
+        ext = os.path.splitext(input_path)[1].lower()
+        if plain_image or ext in OPENCV_FILE_EXT:
+            img = cv2.imread(input_path, cv2.IMREAD_UNCHANGED)
+            if img is not None:
+                return img.astype(np.uint8, copy=False)
+            logging.debug("Unable to decode image with OpenCV, trying GDAL: '%s'", input_path)
+
+        img = np.rollaxis(gdal.Open(input_path).ReadAsArray().astype(np.uint8), 0, 3)
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB if img.shape[2] < 4 else cv2.COLOR_BGRA2RGBA)
+
+    @staticmethod
+    def check_image_quality(img: np.ndarray) -> tuple:
+        """Checks if the image is good enough to mask
+        Arguments:
+            img: the image to check
+        Return:
+            A tuple containing True if the image can be masked and False if not, and the over threshold rate
+            returned by check_saturation()
+        """
+        # calculate image scores
+        over_rate, low_rate = __internal__.check_saturation(img)
+
+        # if low score, return None
+        # low_rate is percentage of low value pixels(lower than 20) in the grayscale image, if low_rate > 0.1, return
+        # aveValue is average pixel value of grayscale image, if aveValue lower than 30 or higher than 195, return
+        # quality_score is a score from Multiscale Autocorrelation (MAC), if quality_score lower than 13, return
+
+        ave_value = __internal__.check_brightness(img)
+        # if not quality_score:
+        #     quality_score = getImageQuality(input_path)
+        if low_rate > 0.1 or ave_value < 30 or ave_value > 195:
+            return False, over_rate
+
+        return True, over_rate
+
     @staticmethod
     def check_saturation(img: np.ndarray) -> list:
         """Checks the saturation of an image
@@ -255,8 +732,12 @@ class __internal__:
             filename: the name of the file to convert to a mask name
         Return:
             The name of the mask file
+        Notes:
+            Masks are saved as TIFF images so the '.tif' extension is used for other image types
         """
         base, ext = os.path.splitext(os.path.basename(filename))
+        if ext.lower() not in TIFF_FILE_EXT:
+            ext = '.tif'
 
         return base + "_mask" + ext
 
@@ -277,46 +758,96 @@ class __internal__:
         return ave_value
 
 
-def gen_cc_enhanced(input_path: str, kernel_size: int = 3) -> tuple:
-    """Generates an image mask keeping plants
+def gen_cc_bin_mask(input_path: str, kernel_size: int = 3, coarse_scale: int = 1, coarse_quality: dict = None,
+                    plain_image: bool = False, quick_check: bool = False) -> tuple:
+    """Generates the binary mask keeping plants
     Arguments:
         input_path: the path to the input image
         kernel_size: the image kernel size for processing
+        coarse_scale: the decimation factor for coarse-to-fine masking; values less than 2 disable it
+        coarse_quality: optional dict that's updated with the comparison of the coarse-to-fine mask against
+                        the full resolution mask (see __internal__.compare_masks())
+        plain_image: set to True if the image isn't georeferenced so it's decoded with OpenCV instead of GDAL
+        quick_check: set to True to reject low quality JPEG images using a reduced size decode before
+                     decoding the full image
     Return:
-        A list containing the percent of unmasked pixels and the masked image
+        A list containing the percent of unmasked pixels, the loaded image, and the binary mask
     """
+    # pylint: disable=too-many-arguments
     # abandon low quality images, mask enhanced
-    img = np.rollaxis(gdal.Open(input_path).ReadAsArray().astype(np.uint8), 0, 3)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB if img.shape[2] < 4 else cv2.COLOR_BGRA2RGBA)
-
-    # calculate image scores
-    # pylint: disable=unused-variable
-    over_rate, low_rate = __internal__.check_saturation(img)
+    if quick_check and os.path.splitext(input_path)[1].lower() in REDUCED_DECODE_FILE_EXT:
+        reduced_img = cv2.imread(input_path, cv2.IMREAD_REDUCED_COLOR_4 | cv2.IMREAD_IGNORE_ORIENTATION)
+        if reduced_img is not None and not __internal__.check_image_quality(reduced_img)[0]:
+            return None, None, None
 
-    # if low score, return None
-    # low_rate is percentage of low value pixels(lower than 20) in the grayscale image, if low_rate > 0.1, return
-    # aveValue is average pixel value of grayscale image, if aveValue lower than 30 or higher than 195, return
-    # quality_score is a score from Multiscale Autocorrelation (MAC), if quality_score lower than 13, return
+    img = __internal__.load_image(input_path, plain_image)
 
-    ave_value = __internal__.check_brightness(img)
-    # if not quality_score:
-    #     quality_score = getImageQuality(input_path)
-    if low_rate > 0.1 or ave_value < 30 or ave_value > 195:
-        return None, None
+    good_quality, over_rate = __internal__.check_image_quality(img)
+    if not good_quality:
+        return None, None, None
 
     # saturated image process
     # over_rate is percentage of high value pixels(higher than SATURATE_THRESHOLD) in the grayscale image, if
     # over_rate > 0.15, try to fix it use gen_saturated_mask()
-    if over_rate > 0.15:
-        bin_mask = __internal__.gen_saturated_mask(img, kernel_size)
-    else:  # normal image process
-        bin_mask = __internal__.gen_mask(img, kernel_size)
+    saturated = over_rate > 0.15
+    if coarse_scale > 1:
+        bin_mask = __internal__.gen_coarse_to_fine_mask(img, kernel_size, saturated, coarse_scale)
+        if coarse_quality is not None:
+            coarse_quality.update(__internal__.compare_masks(__internal__.gen_bin_mask(img, kernel_size, saturated),
+                                                             bin_mask))
+    else:
+        bin_mask = __internal__.gen_bin_mask(img, kernel_size, saturated)
 
     count = np.count_nonzero(bin_mask)
     ratio = count / float(bin_mask.size)
 
+    return ratio, img, bin_mask
+
+
+def gen_cc_masks(input_path: str, kernel_size: int = 3, coarse_scale: int = 1, coarse_quality: dict = None,
+                 plain_image: bool = False, quick_check: bool = False) -> tuple:
+    """Generates the image masks keeping plants
+    Arguments:
+        input_path: the path to the input image
+        kernel_size: the image kernel size for processing
+        coarse_scale: the decimation factor for coarse-to-fine masking; values less than 2 disable it
+        coarse_quality: optional dict that's updated with the comparison of the coarse-to-fine mask against
+                        the full resolution mask (see __internal__.compare_masks())
+        plain_image: set to True if the image isn't georeferenced so it's decoded with OpenCV instead of GDAL
+        quick_check: set to True to reject low quality JPEG images using a reduced size decode before
+                     decoding the full image
+    Return:
+        A list containing the percent of unmasked pixels, the masked image, and the binary mask
+    """
+    # pylint: disable=too-many-arguments
+    ratio, img, bin_mask = gen_cc_bin_mask(input_path, kernel_size, coarse_scale, coarse_quality, plain_image,
+                                           quick_check)
+    if img is None:
+        return None, None, None
+
     rgb_mask = __internal__.gen_rgb_mask(img, bin_mask)
 
+    return ratio, rgb_mask, bin_mask
+
+
+def gen_cc_enhanced(input_path: str, kernel_size: int = 3, coarse_scale: int = 1, coarse_quality: dict = None,
+                    plain_image: bool = False, quick_check: bool = False) -> tuple:
+    """Generates an image mask keeping plants
+    Arguments:
+        input_path: the path to the input image
+        kernel_size: the image kernel size for processing
+        coarse_scale: the decimation factor for coarse-to-fine masking; values less than 2 disable it
+        coarse_quality: optional dict that's updated with the comparison of the coarse-to-fine mask against
+                        the full resolution mask (see __internal__.compare_masks())
+        plain_image: set to True if the image isn't georeferenced so it's decoded with OpenCV instead of GDAL
+        quick_check: set to True to reject low quality JPEG images using a reduced size decode before
+                     decoding the full image
+    Return:
+        A list containing the percent of unmasked pixels and the masked image
+    """
+    # pylint: disable=too-many-arguments
+    ratio, rgb_mask, _ = gen_cc_masks(input_path, kernel_size, coarse_scale, coarse_quality, plain_image, quick_check)
+
     return ratio, rgb_mask
 
 
@@ -326,7 +857,7 @@ class SoilMask(algorithm.Algorithm):
     @property
     def supported_file_ext(self) -> tuple:
         """Returns a tuple of supported file extensions in lowercase (with the preceeding dot: eg '.tif')"""
-        return '.tiff', '.tif'
+        return TIFF_FILE_EXT + OPENCV_FILE_EXT
 
     def add_parameters(self, parser: argparse.ArgumentParser) -> None:
         """Adds parameters
@@ -334,6 +865,28 @@ class SoilMask(algorithm.Algorithm):
             parser: instance of argparse
         """
         parser.add_argument('--out_file', type=str, help='the path to save the masked file to')
+        parser.add_argument('--coarse_scale', type=int, default=1,
+                            help='decimation factor for coarse-to-fine masking; only boundary and uncertain areas are '
+                                 'masked at full resolution (default is 1, always mask at full resolution)')
+        parser.add_argument('--coarse_quality', action='store_true',
+                            help='compare the coarse-to-fine mask against the full resolution mask and add the '
+                                 'results to the metadata')
+        parser.add_argument('--vector_format', choices=[ext[1:] for ext in VECTOR_DRIVERS],
+                            help='also save the plant areas of the mask as polygons in this format')
+        parser.add_argument('--vector_min_area', type=int, default=SMALL_AREA_THRESHOLD,
+                            help='polygons smaller than this number of pixels are not saved (default is %s)' %
+                            str(SMALL_AREA_THRESHOLD))
+        parser.add_argument('--vector_simplify', type=float, default=1.0,
+                            help='polygon simplification tolerance in pixels; 0 disables simplification '
+                                 '(default is 1.0)')
+        parser.add_argument('--quick_check', action='store_true',
+                            help='check the quality of JPEG images using a reduced size decode before decoding the '
+                                 'full image; images close to the quality limits may be accepted or rejected '
+                                 'differently')
+        parser.add_argument('--uncompressed', choices=['rgb', 'mask'],
+                            help='save the masked image (rgb) or the binary mask (mask) as an uncompressed, memory '
+                                 'mappable ENVI image instead of a compressed TIFF image; a .tif or .tiff extension is '
+                                 'replaced with .img')
 
         parser.epilog = 'Mask files are saved with the .msk filename extension added when it\'s not specified. ' + \
                         parser.epilog
@@ -351,9 +904,9 @@ class SoilMask(algorithm.Algorithm):
             an error message if there's an error
         """
         # pylint: disable=unused-argument
-        result = {'code': -1002, 'message': "No TIFF files were specified for processing"}
+        result = {'code': -1002, 'message': "No supported image files were specified for processing"}
 
-        # Ensure we have a TIFF file
+        # Ensure we have a supported image file
         if check_md:
             files = check_md.get_list_files()
             try:
@@ -385,7 +938,7 @@ class SoilMask(algorithm.Algorithm):
             Returns a dictionary with the results of processing
         """
         # Disable pylint checks that negatively affect the code use and readability
-        # pylint: disable=unused-argument, too-many-branches
+        # pylint: disable=unused-argument, too-many-branches, too-many-locals, too-many-statements
         result = {}
         file_md = []
 
@@ -418,29 +971,54 @@ class SoilMask(algorithm.Algorithm):
                 else:
                     # Use the original name
                     rgb_mask_tif = os.path.join(check_md.working_folder, __internal__.get_maskfilename(one_file))
+                if environment.args.uncompressed and os.path.splitext(rgb_mask_tif)[1].lower() in TIFF_FILE_EXT:
+                    # Raw pixels can't be saved with a TIFF extension
+                    rgb_mask_tif = os.path.splitext(rgb_mask_tif)[0] + ".img"
                 # Create the mask file
                 logging.debug("Creating mask file '%s'", rgb_mask_tif)
-                mask_ratio, mask_rgb = gen_cc_enhanced(one_file)
-                if mask_rgb is None:
+                coarse_quality = {} if environment.args.coarse_quality else None
+                mask_ratio, img, mask_bin = gen_cc_bin_mask(one_file, coarse_scale=environment.args.coarse_scale,
+                                                            coarse_quality=coarse_quality, plain_image=epsg is None,
+                                                            quick_check=environment.args.quick_check)
+                if img is None:
                     logging.warning("Skipping over image that failed quality check: %s", one_file)
                     continue
 
-                # Bands must be reordered to avoid swapping R and B
-                mask_rgb = cv2.cvtColor(mask_rgb, cv2.COLOR_BGR2RGB if mask_rgb.shape[2] < 4 else cv2.COLOR_BGRA2RGBA)
-
                 transformer_info = environment.generate_transformer_md()
 
                 image_md = __internal__.prepare_metadata_for_geotiff(transformer_info)
-                if epsg:
-                    geoimage.create_geotiff(mask_rgb, bounds, rgb_mask_tif, epsg, None, False, image_md, compress=True)
+                if environment.args.uncompressed:
+                    # Fill the mapped file directly instead of creating a masked copy of the image
+                    raw_shape = mask_bin.shape if environment.args.uncompressed == 'mask' else img.shape
+                    raw_image = __internal__.create_raw_image(rgb_mask_tif, raw_shape, bounds if epsg else None,
+                                                              epsg, image_md)
+                    if environment.args.uncompressed == 'mask':
+                        np.copyto(raw_image, mask_bin)
+                    else:
+                        # Bands must be reordered to avoid swapping R and B
+                        cv2.cvtColor(img, cv2.COLOR_BGR2RGB if img.shape[2] < 4 else cv2.COLOR_BGRA2RGBA,
+                                     dst=raw_image)
+                        raw_image[mask_bin == 0, :3] = 0
+                    raw_image.flush()
+                    del raw_image
                 else:
-                    geoimage.create_tiff(mask_rgb, rgb_mask_tif, None, False, image_md, compress=True)
+                    mask_rgb = __internal__.gen_rgb_mask(img, mask_bin)
+                    # Bands must be reordered to avoid swapping R and B
+                    mask_rgb = cv2.cvtColor(mask_rgb, cv2.COLOR_BGR2RGB if mask_rgb.shape[2] < 4 else
+                                            cv2.COLOR_BGRA2RGBA)
+                    if epsg:
+                        geoimage.create_geotiff(mask_rgb, bounds, rgb_mask_tif, epsg, None, False, image_md,
+                                                compress=True)
+                    else:
+                        geoimage.create_tiff(mask_rgb, rgb_mask_tif, None, False, image_md, compress=True)
 
                 transformer_md = {
                     'name': transformer_info['name'],
                     'version': transformer_info['version'],
                     'ratio': mask_ratio
                 }
+                if coarse_quality:
+                    transformer_md['coarse_quality'] = coarse_quality
 
                 new_file_md = {'path': rgb_mask_tif,
                                'key': ConfigurationSoilmask.transformer_sensor,
@@ -449,6 +1027,27 @@ class SoilMask(algorithm.Algorithm):
                                }
                               }
                 file_md.append(new_file_md)
+                if environment.args.uncompressed:
+                    file_md.append({'path': os.path.splitext(rgb_mask_tif)[0] + '.hdr',
+                                    'key': ConfigurationSoilmask.transformer_sensor,
+                                    'metadata': {
+                                        'data': transformer_md
+                                    }
+                                   })
+
+                # Save the polygons while the mask is still available
+                if environment.args.vector_format:
+                    vector_file = os.path.splitext(rgb_mask_tif)[0] + '.' + environment.args.vector_format
+                    logging.debug("Creating mask polygon file '%s'", vector_file)
+                    poly_count = __internal__.polygonize_mask(mask_bin, vector_file, bounds if epsg else None, epsg,
+                                                              environment.args.vector_min_area,
+                                                              environment.args.vector_simplify)
+                    file_md.append({'path': vector_file,
+                                    'key': ConfigurationSoilmask.transformer_sensor,
+                                    'metadata': {
+                                        'data': {**transformer_md, 'polygon_count': poly_count}
+                                    }
+                                   })
 
             result['code'] = 0
             result['file'] = file_md
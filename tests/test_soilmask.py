@@ -174,3 +174,334 @@ def test_plain_tiff():
     img = gdal.Open(os.path.join(working_space, orthomosaic_mask_name)).ReadAsArray()
     assert img is not None
     assert isinstance(img, np.ndarray)
+
+
+def test_coarse_to_fine_mask():
+    """Test coarse-to-fine masking against the full resolution mask"""
+    # pylint: disable=import-outside-toplevel
+    import cv2
+    import soilmask as sm
+
+    # Create an image of soil with plants (BGR order)
+    img = np.full((1024, 1024, 3), (60, 90, 120), dtype=np.uint8)
+    for center, radius in [((200, 200), 80), ((700, 300), 120), ((400, 800), 60), ((900, 900), 40)]:
+        cv2.circle(img, center, radius, (40, 140, 60), -1)
+
+    full_mask = sm.__internal__.gen_bin_mask(img, 3, False)
+    for scale in [2, 4]:
+        coarse_mask = sm.__internal__.gen_coarse_to_fine_mask(img, 3, False, scale)
+        assert coarse_mask.shape == full_mask.shape
+        assert coarse_mask.dtype == full_mask.dtype
+
+        quality = sm.__internal__.compare_masks(full_mask, coarse_mask)
+        assert quality['iou'] > 0.99
+        assert quality['differing_pixels'] == np.count_nonzero(full_mask != coarse_mask)
+
+    # Dense canopy is masked at full resolution
+    dense_img = np.full((512, 512, 3), (60, 90, 120), dtype=np.uint8)
+    for row in range(8, 512, 24):
+        for col in range(8, 512, 24):
+            cv2.circle(dense_img, (col, row), 8, (40, 140, 60), -1)
+    assert np.array_equal(sm.__internal__.gen_coarse_to_fine_mask(dense_img, 3, False, 4),
+                          sm.__internal__.gen_bin_mask(dense_img, 3, False))
+
+    # Over saturated images must match the full resolution mask
+    for center, radius in [((300, 500), 250), ((800, 700), 200)]:
+        cv2.circle(img, center, radius, (250, 250, 250), -1)
+    full_mask = sm.__internal__.gen_bin_mask(img, 3, True)
+    for scale in [2, 4]:
+        coarse_mask = sm.__internal__.gen_coarse_to_fine_mask(img, 3, True, scale)
+        assert np.array_equal(coarse_mask, full_mask)
+
+    quality = sm.__internal__.compare_masks(full_mask, full_mask)
+    assert quality['iou'] == 1.0
+    assert quality['differing_pixels'] == 0
+    assert quality['differing_ratio'] == 0.0
+
+
+def test_gen_mask_clipped_edges():
+    """Test that holes cut by a clipped window edge aren't filled"""
+    # pylint: disable=import-outside-toplevel
+    import soilmask as sm
+
+    # Plants with a small area of soil along the top edge (BGR order)
+    img = np.full((200, 300, 3), (40, 140, 60), dtype=np.uint8)
+    img[0:20, 100:200] = (60, 90, 120)
+    soil = np.zeros((200, 300), dtype=bool)
+    soil[0:20, 100:200] = True
+
+    # The soil is filled as a small hole when the top edge is the image edge
+    assert np.all(sm.__internal__.gen_mask(img, 3) > 0)
+    assert np.all(sm.__internal__.gen_mask(img, 3, (False, True, True, True)) > 0)
+
+    # The soil is kept when the top edge cuts through a larger image
+    bin_mask = sm.__internal__.gen_mask(img, 3, (True, False, False, False))
+    assert np.count_nonzero(bin_mask[soil] == 0) > 1500
+    assert np.all(bin_mask[40:, :] > 0)
+
+
+def test_polygonize_mask():
+    """Test saving a mask as polygons"""
+    # pylint: disable=import-outside-toplevel
+    from osgeo import ogr
+    import soilmask as sm
+
+    # Two plants and one area that's too small to keep
+    bin_mask = np.zeros((300, 300), dtype=np.uint8)
+    bin_mask[10:60, 10:60] = 255
+    bin_mask[100:250, 150:290] = 255
+    bin_mask[280:285, 10:15] = 255
+
+    working_space = os.path.realpath('./test_results')
+    os.makedirs(working_space, exist_ok=True)
+
+    bounds = (32.0, 32.003, -111.003, -111.0)
+    pixel_area = ((bounds[1] - bounds[0]) / 300) * ((bounds[3] - bounds[2]) / 300)
+    for vector_name in ['polygons.geojson', 'polygons.gpkg']:
+        vector_file = os.path.join(working_space, vector_name)
+        # Use tiles smaller than the mask to check the polygons are saved from all tiles: the large plant is
+        # split into 4 pieces and the small area is removed
+        poly_count = sm.__internal__.polygonize_mask(bin_mask, vector_file, bounds, 4326, min_area=100, tile_size=200)
+        assert poly_count == 5
+        assert os.path.exists(vector_file)
+
+        vector_ds = ogr.Open(vector_file)
+        layer = vector_ds.GetLayer(0)
+        assert layer.GetFeatureCount() == poly_count
+        for feature in layer:
+            area = feature.GetGeometryRef().GetArea()
+            assert area >= 100 * pixel_area
+            # The area field is in pixels
+            assert feature.GetField('area') >= 100
+            assert abs(feature.GetField('area') * pixel_area - area) <= area * 1e-6
+        layer.ResetReading()
+        min_x, max_x, min_y, max_y = layer.GetExtent()
+        assert bounds[2] <= min_x < max_x <= bounds[3]
+        assert bounds[0] <= min_y < max_y <= bounds[1]
+        vector_ds = None
+
+    # A narrow piece of a large plant crossing a tile edge is kept
+    bin_mask = np.zeros((300, 300), dtype=np.uint8)
+    bin_mask[10:40, 198:240] = 255
+    vector_file = os.path.join(working_space, 'polygons_edge.geojson')
+    poly_count = sm.__internal__.polygonize_mask(bin_mask, vector_file, bounds, 4326, min_area=100, simplify=0,
+                                                 tile_size=200)
+    assert poly_count == 2
+
+
+def test_vector_command_line():
+    """Runs the command line saving the mask polygons and tests the result"""
+    orthomosaic_mask_name = 'orthomosaic_mask.tif'
+    vector_name = 'orthomosaic_mask.geojson'
+    result_name = 'result.json'
+    source_image = os.path.join(TESTING_FILE_PATH, 'orthomosaic.tif')
+    source_metadata = os.path.join(TESTING_FILE_PATH, 'experiment.yaml')
+    assert os.path.exists(source_image)
+    assert os.path.exists(source_metadata)
+
+    working_space = os.path.realpath('./test_results')
+    os.makedirs(working_space, exist_ok=True)
+
+    command_line = [SOURCE_PATH, '--metadata', source_metadata, '--working_space', working_space,
+                    '--vector_format', 'geojson', source_image]
+    subprocess.run(command_line, check=True)
+
+    # Check that the expected files were created
+    for expected_file in [result_name, orthomosaic_mask_name, vector_name]:
+        assert os.path.exists(os.path.join(working_space, expected_file))
+
+    # Inspect the created files
+    with open(os.path.join(working_space, result_name), encoding='utf-8') as in_file:
+        res = json.load(in_file)
+        assert 'code' in res
+        assert res['code'] == 0
+
+
+def test_load_image():
+    """Test that images decoded with OpenCV match the images decoded with GDAL"""
+    # pylint: disable=import-outside-toplevel
+    import cv2
+    import soilmask as sm
+
+    source_image = os.path.join(TESTING_FILE_PATH, 'orthomosaic.tif')
+    assert os.path.exists(source_image)
+
+    gdal_img = sm.__internal__.load_image(source_image)
+    assert gdal_img is not None
+
+    # PNG images are lossless so the pixels must be the same
+    png_image = os.path.join(TESTING_FILE_PATH, 'plain.png')
+    PIL.Image.open(source_image).save(png_image)
+    for plain_image in [False, True]:
+        png_img = sm.__internal__.load_image(png_image, plain_image)
+        assert png_img.shape == gdal_img.shape
+        assert np.array_equal(png_img, gdal_img)
+
+    # Plain TIFF images can be decoded with OpenCV when requested
+    plain_tiff_image = os.path.join(TESTING_FILE_PATH, 'plain.tif')
+    PIL.Image.open(source_image).save(plain_tiff_image)
+    assert np.array_equal(sm.__internal__.load_image(plain_tiff_image, True), gdal_img)
+
+    # JPEG images decoded with OpenCV are compared to the GDAL decode; different libjpeg builds can round
+    # the color conversion differently so pixel values may differ by one
+    jpeg_image = os.path.join(TESTING_FILE_PATH, 'plain_decode.jpg')
+    PIL.Image.open(source_image).convert('RGB').save(jpeg_image, quality=95)
+    jpeg_gdal_img = np.rollaxis(gdal.Open(jpeg_image).ReadAsArray().astype(np.uint8), 0, 3)
+    jpeg_gdal_img = cv2.cvtColor(jpeg_gdal_img, cv2.COLOR_BGR2RGB)
+    jpeg_img = sm.__internal__.load_image(jpeg_image)
+    assert jpeg_img.shape == jpeg_gdal_img.shape
+    assert np.max(np.abs(jpeg_img.astype(int) - jpeg_gdal_img.astype(int))) <= 1
+    quality = sm.__internal__.compare_masks(sm.__internal__.gen_mask(jpeg_gdal_img, 3),
+                                            sm.__internal__.gen_mask(jpeg_img, 3))
+    assert quality['differing_ratio'] < 0.001
+
+
+def test_jpeg_image():
+    """Runs the command line for a JPEG file and tests the result"""
+    orthomosaic_mask_name = 'plain_mask.tif'
+    result_name = 'result.json'
+    source_image = os.path.join(TESTING_FILE_PATH, 'orthomosaic.tif')
+    source_metadata = os.path.join(TESTING_FILE_PATH, 'experiment.yaml')
+    assert os.path.exists(source_image)
+    assert os.path.exists(source_metadata)
+
+    # Create a JPEG image from the source image
+    jpeg_image = os.path.join(TESTING_FILE_PATH, 'plain.jpg')
+    if os.path.exists(jpeg_image):
+        os.unlink(jpeg_image)
+    PIL.Image.open(source_image).convert('RGB').save(jpeg_image, quality=95)
+
+    # Setup parameters for running the test
+    working_space = os.path.realpath('./test_results')
+    os.makedirs(working_space, exist_ok=True)
+    for expected_file in [result_name, orthomosaic_mask_name]:
+        cur_path = os.path.join(working_space, expected_file)
+        if os.path.exists(cur_path):
+            os.unlink(cur_path)
+
+    command_line = [SOURCE_PATH, '--metadata', source_metadata, '--working_space', working_space,
+                    '--quick_check', jpeg_image]
+    subprocess.run(command_line, check=True)
+
+    # Check that the expected files were created
+    for expected_file in [result_name, orthomosaic_mask_name]:
+        assert os.path.exists(os.path.join(working_space, expected_file))
+
+    # Inspect the created files
+    with open(os.path.join(working_space, result_name), encoding='utf-8') as in_file:
+        res = json.load(in_file)
+        assert 'code' in res
+        assert res['code'] == 0
+
+    img = gdal.Open(os.path.join(working_space, orthomosaic_mask_name)).ReadAsArray()
+    assert img is not None
+    assert isinstance(img, np.ndarray)
+
+
+def test_raw_image():
+    """Test creating, filling, and mapping an uncompressed image"""
+    # pylint: disable=import-outside-toplevel
+    import soilmask as sm
+
+    working_space = os.path.realpath('./test_results')
+    os.makedirs(working_space, exist_ok=True)
+
+    bounds = (32.0, 32.003, -111.003, -111.0)
+    for shape in [(200, 300), (200, 300, 3), (200, 300, 4)]:
+        pixels = np.random.randint(0, 256, shape, dtype=np.uint8)
+        raw_file = os.path.join(working_space, 'raw_%s.img' % str(len(shape)))
+
+        raw_image = sm.__internal__.create_raw_image(raw_file, shape, bounds, 4326, {'test': 'value'})
+        np.copyto(raw_image, pixels)
+        raw_image.flush()
+        del raw_image
+
+        # Read the image with GDAL
+        raster = gdal.Open(raw_file)
+        assert raster is not None
+        assert raster.RasterCount == (shape[2] if len(shape) > 2 else 1)
+        gdal_pixels = raster.ReadAsArray()
+        if len(shape) > 2:
+            gdal_pixels = np.rollaxis(gdal_pixels, 0, 3)
+        assert np.array_equal(gdal_pixels, pixels)
+        geotransform = raster.GetGeoTransform()
+        assert geotransform[0] == bounds[2]
+        assert geotransform[3] == bounds[1]
+        raster = None
+
+        # Map the image
+        mapped = sm.__internal__.open_raw_image(raw_file)
+        assert mapped.shape == shape
+        assert np.array_equal(mapped, pixels)
+        del mapped
+
+
+def test_uncompressed_command_line():
+    """Runs the command line saving an uncompressed image and tests the result against the compressed image"""
+    # pylint: disable=import-outside-toplevel
+    import soilmask as sm
+
+    orthomosaic_mask_name = 'orthomosaic_mask.img'
+    result_name = 'result.json'
+    source_image = os.path.join(TESTING_FILE_PATH, 'orthomosaic.tif')
+    source_metadata = os.path.join(TESTING_FILE_PATH, 'experiment.yaml')
+    assert os.path.exists(source_image)
+    assert os.path.exists(source_metadata)
+
+    working_space = os.path.realpath('./test_results')
+    os.makedirs(working_space, exist_ok=True)
+
+    # Generate the compressed image to compare against
+    compressed_name = 'compressed.tif'
+    command_line = [SOURCE_PATH, '--metadata', source_metadata, '--working_space', working_space,
+                    '--out_file', compressed_name, source_image]
+    subprocess.run(command_line, check=True)
+    compressed_img = gdal.Open(os.path.join(working_space, compressed_name)).ReadAsArray()
+    compressed_img = np.rollaxis(compressed_img, 0, 3)
+    _, _, expected_mask = sm.gen_cc_masks(source_image)
+
+    for uncompressed in ['rgb', 'mask']:
+        command_line = [SOURCE_PATH, '--metadata', source_metadata, '--working_space', working_space,
+                        '--uncompressed', uncompressed, source_image]
+        subprocess.run(command_line, check=True)
+
+        # Check that the expected files were created
+        for expected_file in [result_name, orthomosaic_mask_name]:
+            assert os.path.exists(os.path.join(working_space, expected_file))
+
+        # Inspect the created files
+        with open(os.path.join(working_space, result_name), encoding='utf-8') as in_file:
+            res = json.load(in_file)
+            assert 'code' in res
+            assert res['code'] == 0
+
+        # The mapped pixels must match the compressed image
+        mapped = sm.__internal__.open_raw_image(os.path.join(working_space, orthomosaic_mask_name))
+        if uncompressed == 'rgb':
+            assert np.array_equal(mapped, compressed_img)
+        else:
+            assert np.array_equal(mapped, expected_mask)
+            # Soil is black in the compressed image
+            assert not np.any(compressed_img[mapped == 0, :3])
+        del mapped
+
+    # A TIFF extension is replaced and other extensions are kept
+    for out_file_name, expected_name in [('uncompressed.tif', 'uncompressed.img'),
+                                         ('uncompressed.raw', 'uncompressed.raw')]:
+        command_line = [SOURCE_PATH, '--metadata', source_metadata, '--working_space', working_space,
+                        '--uncompressed', 'rgb', '--out_file', out_file_name, source_image]
+        subprocess.run(command_line, check=True)
+        assert os.path.exists(os.path.join(working_space, expected_name))
+        assert os.path.exists(os.path.join(working_space, 'uncompressed.hdr'))
+        raster = gdal.Open(os.path.join(working_space, expected_name))
+        assert raster is not None
+        assert raster.GetDriver().ShortName == 'ENVI'
+        raster = None
+
+        # Both the image and its header are returned
+        with open(os.path.join(working_space, result_name), encoding='utf-8') as in_file:
+            res = json.load(in_file)
+            assert res['code'] == 0
+            returned_files = [os.path.basename(one_file['path']) for one_file in res['file']]
+            assert expected_name in returned_files
+            assert 'uncompressed.hdr' in returned_files